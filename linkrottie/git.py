@@ -1,16 +1,37 @@
 import logging
+import os
 import subprocess
 import re
-from collections import namedtuple
+from collections import namedtuple, deque
+from dataclasses import dataclass
 from pathlib import Path
 from urllib.parse import urljoin
 from typing import Self
 from threading import Lock
 
-from .taskqueue import taskqueue
+from .taskqueue import ThreadedTaskQueue
 
 log = logging.getLogger(__name__)
 
+STDERR_LINES = 64       # Lines of git error output kept for logging
+
+# URL specified locations
+_URL_RE = re.compile(r'''
+    (\w+)://                # scheme,   exclude ://
+    ([^/?#@:]+@)?           # user,     include @
+    ([^/?#@:]+)             # host
+    (:\d+)?                 # port,     include :
+    (/.*)                   # path
+''', re.X)
+
+# SCP specified locations
+_SCP_RE = re.compile(r'''
+    ([^/?#@:]+@)?           # user,     include @
+    ([^/?#@:]*)             # host
+    :
+    (.*)                    # path
+''', re.X)
+
 class Local:
     """Represents locally stored git repositories.
     
@@ -23,7 +44,13 @@ class Local:
 
         self._ar_lock = Lock()
         with self._ar_lock:
-            self.already_requested = []
+            self.already_requested = set()
+            self._seen_urls = set()
+
+        # Names of the subdirectories of each directory mirrors live in
+        self._dir_lock = Lock()
+        with self._dir_lock:
+            self._existing = {}
 
         try:
             aliases = config['aliases']
@@ -44,59 +71,73 @@ class Local:
             self.aliases_text = {}
             self.aliases_regex = []
     
+    def _is_mirrored(self, local:Path) -> bool:
+        """Determine whether there's already a mirror at local.
+
+        Rather than stat every mirror, scan each parent directory once, the
+        first time anything in it is asked about.  Each mirror is only asked
+        about once, so there's no need to track the ones we create.
+
+        The scan only answers yes.  On a case-insensitive filesystem the
+        mirror may be there under a name that differs in case, so a miss
+        still gets a stat, which is the clone path anyway.
+        """
+
+        parent = local.parent
+        with self._dir_lock:
+            names = self._existing.get(parent)
+            if names is None:
+                try:
+                    with os.scandir(parent) as it:
+                        names = {entry.name for entry in it if entry.is_dir()}
+                except FileNotFoundError:
+                    names = set()
+                self._existing[parent] = names
+        return local.name in names or local.is_dir()
+
     def _clone(self, remote:str, local:Path):
         """Make a mirror clone of the git repository at remote."""
         
+        # mkdir is a no-op for an existing directory, no need to check first.
         parent = local.parent
-        if not parent.is_dir():
-            log.info('Creating directory %s', parent)
-            parent.mkdir(parents=True, exist_ok=True)
+        parent.mkdir(parents=True, exist_ok=True)
         
         log.info('Cloning %s to %s', remote, local)
-        result = subprocess.run(
-            ['git', 'clone', '--mirror', remote, local.name],
-            capture_output=True, text=True,
+        returncode, output = _run_git(
+            ['clone', '--mirror', remote, local.name],
             cwd = parent
         )
-        if result.returncode:
+        if returncode:
             log.error("git clone --mirror %s %s returned with %s: %s",
-                remote, local.name, result.returncode, result.stderr or result.stdout
+                remote, local.name, returncode, output
             )
             
     def _update(self, local:Path):
         """Perform an update of the existing mirror clone at local."""
         
+        # fetch.parallel=0 lets git fetch multiple remotes at once with
+        # however many jobs it thinks reasonable.  No --prune; refs deleted
+        # upstream are exactly what a backup should hang on to.
         log.info('Updating %s', local)
-        result = subprocess.run(
-            ['git', 'remote', 'update'],
-            capture_output=True, text=True,
+        returncode, output = _run_git(
+            ['-c', 'fetch.parallel=0', 'remote', 'update'],
             cwd = local
         )
-        if result.returncode:
+        if returncode:
             log.error("git remote update of %s returned with %s: %s",
-                local.name, result.returncode, result.stderr or result.stdout
+                local.name, returncode, output
             )
     
-    def _get_submodules(self, local:Path):
-        """Yield all submodule URLs from the head of the local repo."""
-        
-        submodules_file = get_submodules_file(local)
-        if not submodules_file:
-            return
-        
-        for line in submodules_file.splitlines():
-            mo = re.match(r'\s+url\s*=\s*', line)
-            if mo:
-                url = line[mo.end():]
-                yield url
-    
-    def mirror_repo(self, remote:str):
+    def mirror_repo(self, remote:str, tq:ThreadedTaskQueue):
         """Create a local mirror clone of the git repository at remote.
         
         Local path is self.path / host / path, so for instance if self.path is
         ./local and remote = git@github.com:highland-technology-inc/linkrottie.git
         the mirror will be at
         ./local/github.com/highland-technology-inc/linkrottie.git
+
+        Any submodules of the repository are queued on tq to be mirrored
+        as well.
         
         """
 
@@ -111,6 +152,14 @@ class Local:
         if remote != originalremote:
             log.debug('Translated %s to %s', originalremote, remote)
 
+        # Submodules often point many repos at the same URL; skip the parse
+        # entirely for those we've already handled.
+        with self._ar_lock:
+            if remote in self._seen_urls:
+                log.debug('Already evalulated %s', remote)
+                return
+            self._seen_urls.add(remote)
+
         # Use the remote URL to determine the local storage path
         repo = RemoteRepo.parse_url(remote)
         local = self.path / repo.host / repo.path.lstrip('/')
@@ -119,17 +168,16 @@ class Local:
             if local in self.already_requested:
                 log.debug('Already evalulated %s', local)
                 return
-            self.already_requested.append(local)
+            self.already_requested.add(local)
 
         # Make a new clone or update an existing one as appropriate.
-        if not local.is_dir():
+        if not self._is_mirrored(local):
             self._clone(remote, local)
         else:
             self._update(local)    
         
         # Queue any submodules of this repo for mirroring as well.
-        tq = taskqueue()
-        for url in self._get_submodules(local):
+        for url in get_submodule_urls(local):
             if url.startswith('..') or url.startswith('/'):
                 # This is a local reference, rather than an absolute one.
                 # Slap it together with the existing remote URL to get an
@@ -138,58 +186,47 @@ class Local:
                 url = repo.join_url(url).deparse()
 
             log.debug('Found submodule %s', url)
-            tq.append(self.mirror_repo, url, desc='Submodule ' + url)
+            tq.append(self.mirror_repo, url, tq, desc='Submodule ' + url)
 
+@dataclass(slots=True, frozen=True)
 class RemoteRepo:
     """Represents the parts of a remote repository."""
-    def __init__(self, scheme, user, host, port, path):
-        self.scheme = scheme or ''
-        self.user = user or ''
-        self.host = host or ''
-        self.port = port or ''
-        self.path = path or ''
-
-    def __repr__(self) -> str:
-        return "{}({},{},{},{},{})".format(
-            type(self).__name__,
-            self.scheme,
-            self.user,
-            self.host,
-            self.port,
-            self.path
-        )
+    scheme: str = ''
+    user: str = ''
+    host: str = ''
+    port: str = ''
+    path: str = ''
 
     @staticmethod
     def parse_url(url:str) -> Self:
         """Parse a URL that points to a remote git repository into
         constituent parts."""
         
-        # Look for URL specified locations
-        mo = re.match(r'''
-            (\w+)://                # scheme,   exclude ://
-            ([^/?#@:]+@)?           # user,     include @
-            ([^/?#@:]+)             # host
-            (:\d+)?                 # port,     include :
-            (/.*)                   # path
-        ''', url, re.X)
-        
-        if mo:
-            # Extract and clean the parts of the URL
-            return RemoteRepoUrl(*mo.groups())
+        # Both URL and SCP locations need a colon ahead of the first slash,
+        # so check that before paying for a regex match that can't succeed.
+        colon = url.find(':')
+        slash = url.find('/')
+        if colon < 0 or 0 <= slash < colon:
+            colon = -1
+
+        # Look for URL specified locations.  This stays a regex rather than
+        # urllib.parse.urlsplit: that's pure Python and several times slower
+        # than one compiled match, and its hostname is lowercased, which
+        # would move existing mirrors.
+        if colon > 0 and url.startswith('://', colon):
+            mo = _URL_RE.match(url)
+            if mo:
+                # Extract and clean the parts of the URL
+                return RemoteRepoUrl(*(g or '' for g in mo.groups()))
 
         # Look for SCP specified locations, translate them
         # into SSH style
-        mo = re.match(r'''
-            ([^/?#@:]+@)?           # user,     include @
-            ([^/?#@:]*)             # host
-            :
-            (.*)                    # path
-        ''', url, re.X)
-        if mo:
-            scheme = port = None
-            user, host, path = mo.groups()
-            return RemoteRepoScp(scheme, user, host, port, path)
-            
+        if colon >= 0:
+            mo = _SCP_RE.match(url)
+            if mo:
+                user, host, path = mo.groups()
+                return RemoteRepoScp(user=user or '', host=host, path=path)
+
         # Look for local file specified locations
         if url.startswith('file://'):
             return RemoteRepoFile('file://', '', '', '', url[7:])
@@ -204,75 +241,114 @@ class RemoteRepo:
             relative = relative[1:]
             p = ''
         
-        while relative.startswith('../'):
-            relative = relative[3:]
-            p, _, _ = p.rpartition('/')
+        # Count the ../ hops up front, then drop that many trailing
+        # components in one go rather than one slice per hop.
+        up = 0
+        while relative.startswith('../', 3 * up):
+            up += 1
+        if up:
+            relative = relative[3 * up:]
+            parts = p.rsplit('/', up)
+            p = parts[0] if len(parts) > up else ''
 
         if relative:
             p = p + '/' + relative
         
         return type(self)(self.scheme, self.user, self.host, self.port, p)
 
+@dataclass(slots=True, frozen=True)
 class RemoteRepoUrl(RemoteRepo):
     """Represents the parts of a remote repository in URL format."""
 
     def deparse(self):
         return f'{self.scheme}://{self.user}{self.host}{self.port}{self.path}'
 
+@dataclass(slots=True, frozen=True)
 class RemoteRepoScp(RemoteRepo):
     """Represents the parts of a remote repository in SCP format."""
 
     def deparse(self):
         return f'{self.user}{self.host}:{self.path}'
 
+@dataclass(slots=True, frozen=True)
 class RemoteRepoFile(RemoteRepo):
     """Represents the parts of a remote repository in file format."""
 
     def deparse(self):
         return self.host + self.path
 
-def get_submodules_file(repo_path:Path) -> str:
-    """Gets the Git .gitmodules file from the head of repo.
+def get_submodule_urls(repo_path:Path) -> list[str]:
+    """Gets the URLs of all submodules from the head of repo.
     
-    This file describes all submodules used by the repository.  This
-    function works properly on both working and bare repositories.
+    These come from the .gitmodules file, read through git's own config
+    parser rather than ours.  This function works properly on both working
+    and bare repositories.
     
     Returns:
-        The text of the file, or None if the file is not present.
+        A list of submodule URLs, empty if the .gitmodules file is not present.
         
     Raises:
         FileNotFoundError if the path is not a git repository, or a
         CalledProcessError if things fail for some other reason.
     """
     
-    
     result = subprocess.run(
-        ['git', 'show', 'HEAD:.gitmodules'],
+        ['git', 'config', '--blob', 'HEAD:.gitmodules', '-z',
+            '--get-regexp', r'^submodule\..*\.url$'],
         capture_output=True,
-        cwd=repo_path,
-        encoding='utf-8'
+        cwd=repo_path
     )
     if result.returncode:
-        if "'.gitmodules' does not exist" in result.stderr:
-            # No submodules
-            return None
+        if b'unable to resolve config blob' in result.stderr:
+            # No submodules, or no commits
+            return []
         
-        if "invalid object name 'HEAD'" in result.stderr:
-            # No commits
-            return None
+        if result.returncode == 1 and not result.stderr:
+            # A .gitmodules file with no URLs in it
+            return []
         
-        if 'not a git repository' in result.stderr:
+        if (b'not a git repository' in result.stderr or
+                b'only be used inside a git repository' in result.stderr):
             raise FileNotFoundError(f'Not a git repository: {repo_path}')
         
-        log.error('unknown error in get_submodules_file(%s): %s', repo_path, result.stderr)
+        log.error('unknown error in get_submodule_urls(%s): %s', repo_path, _output(result))
         result.check_returncode()
 
-    return result.stdout
+    # With -z, each entry is the key and value separated by a newline.
+    return [
+        entry.partition(b'\n')[2].decode('utf-8')
+            for entry in result.stdout.split(b'\0') if entry
+    ]
+
+def _run_git(args:list[str], cwd:Path) -> tuple[int, str]:
+    """Run a git command for its side effects.
+
+    Standard output is discarded.  Standard error is read as it arrives,
+    but only the last STDERR_LINES lines are kept for error logging, so a
+    long-running clone can't pile up its whole transcript in memory.
+
+    Returns:
+        The return code, and the tail of standard error.
+    """
+    with subprocess.Popen(['git', *args], cwd=cwd,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) as proc:
+        tail = deque(proc.stderr, maxlen=STDERR_LINES)
+    return proc.returncode, b''.join(tail).decode('utf-8', errors='replace')
+
+def _output(result:subprocess.CompletedProcess) -> str:
+    """Decode the error output of a finished git command for logging.
+
+    Output is captured as bytes, and only decoded here on the error path.
+    """
+    return (result.stderr or result.stdout).decode('utf-8', errors='replace')
 
 _local = None
+_local_lock = Lock()
+
 def local(config:dict):
     """Return the singleon Local object."""
     global _local
-    if not _local:
-        _local = Local(config)
-    return _local
+    with _local_lock:
+        if not _local:
+            _local = Local(config)
+        return _local
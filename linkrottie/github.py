@@ -3,15 +3,44 @@ from pathlib import Path
 from urllib.parse import parse_qs
 import re
 import time
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+# orjson decodes straight from the response bytes, and much faster, but
+# it's optional.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 from . import git
-from .taskqueue import taskqueue
+from .taskqueue import ThreadedTaskQueue
 
 APP_CLIENT_ID='Iv23liJmy1ntxW2kskqG'
+MAX_PAGE_REQUESTS = 8       # Most pages of repositories to request at once
+GRAPHQL_URL = 'https://api.github.com/graphql'
 
 log = logging.getLogger(__name__)
 
+# Parts of the Link header on paginated API responses
+_NEXT_LINK_RE = re.compile(r'<([^>]+)>;\s*rel="next"')
+_LAST_PAGE_RE = re.compile(r'[?&]page=(\d+)[^>]*>;\s*rel="last"')
+
+# One page of an organization's repositories, with only the fields we use
+_ORG_REPOS_QUERY = """
+query($org: String!, $after: String) {
+  organization(login: $org) {
+    repositories(first: 100, after: $after) {
+      pageInfo { endCursor hasNextPage }
+      nodes { name nameWithOwner sshUrl }
+    }
+  }
+}
+"""
+
 class Github:
     """A class for gathering repository information from Github.
     
@@ -26,9 +55,12 @@ class Github:
 
     If new_uat is provided, updates the auth_key_file rather than read it.
 
+    If session is provided, it should come from github_session(), and can
+    be shared among several Github objects.
+
     """
 
-    def __init__(self, org: str, config: dict, new_uat:str=None):
+    def __init__(self, org: str, config: dict, new_uat:str=None, session:requests.Session=None):
         # Look for authentication mechanisms
         self.authentication = None
         if 'auth_key_file' in config:
@@ -43,78 +75,196 @@ class Github:
                     print(new_uat, file=f)
                 self.key = new_uat
             else:
-                with open(config['auth_key_file'], 'r') as f:
-                    self.key = f.readline().strip()
+                # Tokens are plain ASCII, no need for the text-mode decoder.
+                with open(filename, 'rb') as f:
+                    self.key = f.readline().strip().decode('ascii')
         
         self.organization = org
-            
-        self.session = requests.Session()
-        self.session.headers.update({
-            'Accept' : 'application/vnd.github+json',
-            'Authorization' : f'Bearer {self.key}', 
-            'X-Github-Api-Version' : '2022-11-28',
-        })
+
+        # Organizations can have different keys, so authorization goes on
+        # each request rather than on a session they might be sharing.
+        self.session = session or github_session()
+        self.auth_headers = {'Authorization' : f'Bearer {self.key}'}
         
         self.dry_run = config.get('dry_run', False)
-        self.ignore = [x.casefold() for x in config.get('ignore', [])]
+        self.ignore = frozenset(x.casefold() for x in config.get('ignore', []))
         
         log.debug("Github getter created with %s authorization", self.authentication)
 
+    def _get_page(self, url:str, params:dict=None) -> requests.Response:
+        """Get one page of repositories from a URL."""
+
+        response = self.session.get(url, params=params, headers=self.auth_headers, timeout=(5, 30))
+        response.raise_for_status()
+        return response
+
     def _get_org_repos(self, url:str):
         """Get all repositories from a URL.
 
-        If there's are next links, continue through those as well.
+        If the first page of results has a "last" link, all the remaining
+        pages are requested at once.  Otherwise, if there are next links,
+        continue through those one at a time.
         
         Yields:
-            Dicts containing repository information.
+            Dicts containing repository information, in no particular order.
         
         """
         
+        params = {'type': 'all', 'per_page': 100}
         while url:
-            response = self.session.get(url, params={'type': 'all'})
-            response.raise_for_status()
+            response = self._get_page(url, params)
 
             # First go through all the repos in this search result
-            json = response.json()
-            log.debug("Found %d repositories at %s", len(json), response.request.url)
-            yield from json
-
-            # Next, see if there's a "next" link on in the headers, in which case
-            # there's another page of results to go through.
-            url = None
-            try:
-                link = response.headers['link']
-                mo = re.search(r'<([^>]+)>; rel="next"', link)
-                if mo:
-                    url = mo.group(1)
-                    log.debug("Following next repo link to %s", url)
-            except KeyError:
-                pass
-
-    def mirror_org_repos(self):
+            repos = json_loads(response.content)
+            log.debug("Found %d repositories at %s", len(repos), response.request.url)
+            yield from repos
+
+            link = response.headers.get('link', '')
+
+            # If we know how many pages there are, there's no need to wait on
+            # each one to find the next.
+            mo = params and 'rel="last"' in link and _LAST_PAGE_RE.search(link)
+            if mo:
+                pages = range(2, int(mo.group(1)) + 1)
+                log.debug("Requesting pages %d-%d of %s", pages.start, pages.stop - 1, url)
+                with ThreadPoolExecutor(max_workers=min(len(pages), MAX_PAGE_REQUESTS)) as pool:
+                    futures = {
+                        pool.submit(self._get_page, url, dict(params, page=page)) : page
+                            for page in pages
+                    }
+
+                    # One bad page shouldn't cost us the repositories on all
+                    # the others.
+                    for future in as_completed(futures):
+                        try:
+                            response = future.result()
+                        except requests.RequestException as e:
+                            log.error("Unable to get page %d of %s: %s", futures[future], url, e)
+                            continue
+                        repos = json_loads(response.content)
+                        log.debug("Found %d repositories at %s", len(repos), response.request.url)
+                        yield from repos
+                return
+
+            # Otherwise, see if there's a "next" link on in the headers, in which
+            # case there's another page of results to go through.  It already
+            # carries the query parameters.
+            url = params = None
+            mo = 'rel="next"' in link and _NEXT_LINK_RE.search(link)
+            if mo:
+                url = mo.group(1)
+                log.debug("Following next repo link to %s", url)
+
+    def _get_org_repos_graphql(self):
+        """Get all repositories of the organization from the GraphQL API.
+
+        This asks for only the fields we use, 100 repositories to a request,
+        rather than the full REST description of each one.
+        
+        Yields:
+            Dicts containing the same name, full_name and ssh_url keys as
+            the REST API's repository information.
+
+        Raises:
+            ValueError if Github reports errors in the query, for instance
+            if the token can't read the organization.
+        """
+
+        variables = {'org': self.organization, 'after': None}
+        while True:
+            response = self.session.post(GRAPHQL_URL,
+                json={'query': _ORG_REPOS_QUERY, 'variables': variables},
+                headers=self.auth_headers, timeout=(5, 30)
+            )
+            response.raise_for_status()
+            result = json_loads(response.content)
+            if result.get('errors'):
+                raise ValueError('Github reports error ' + result['errors'][0]['message'])
+
+            repos = result['data']['organization']['repositories']
+            log.debug("Found %d repositories for %s", len(repos['nodes']), self.organization)
+            for node in repos['nodes']:
+                yield {
+                    'name' : node['name'],
+                    'full_name' : node['nameWithOwner'],
+                    'ssh_url' : node['sshUrl'],
+                }
+
+            if not repos['pageInfo']['hasNextPage']:
+                return
+            variables['after'] = repos['pageInfo']['endCursor']
+
+    def _get_repos(self):
+        """Get all repositories of the organization.
+
+        Uses GraphQL, falling back to the REST API if that fails.  Anything
+        the GraphQL query found before failing may come around again, which
+        is harmless since mirroring a repository twice does nothing.
+        
+        Yields:
+            Dicts containing repository information.
+        """
+
+        org = self.organization
+        try:
+            yield from self._get_org_repos_graphql()
+        except (requests.RequestException, ValueError) as e:
+            log.warning('GraphQL query for %s repositories failed, using REST: %s', org, e)
+            yield from self._get_org_repos(f'https://api.github.com/orgs/{org}/repos')
+
+    def mirror_org_repos(self, tq:ThreadedTaskQueue):
         """Query Github for all the repositories associated with this organization,
-        and request they be mirrored.
+        and request they be mirrored by queuing tasks on tq.
         """
         
-        tq = taskqueue()
+        local = git.local(None)
 
         org = self.organization
         log.info('Getting %s repositories', org)
-        url = f'https://api.github.com/orgs/{org}/repos'
 
-        for repo in self._get_org_repos(url):
+        for repo in self._get_repos():
             fullname = repo['full_name']
             if repo['name'].casefold() in self.ignore:
                 log.debug('Ignoring %s', fullname)
                 continue
             
             ssh  = repo['ssh_url']
-            local = git.local(None)
 
             log.info('Mirroring Github repository %s', fullname)
             if not self.dry_run:
-                tq.append(local.mirror_repo, ssh, desc=f'Mirror {fullname}')
+                tq.append(local.mirror_repo, ssh, tq, desc=f'Mirror {fullname}')
             
+def github_session(maxsize:int = MAX_PAGE_REQUESTS) -> requests.Session:
+    """Create a requests Session for the Github API.
+    
+    Sharing one among all the Github objects lets every organization reuse
+    the same pool of open connections.
+
+    Args:
+        maxsize: Most connections to keep open.  A session shared by
+            organizations being gathered at once needs room for all of
+            their page requests.
+    """
+    
+    # Keep a connection alive for each page we might request at once, so
+    # that none of them has to pay for a new TLS handshake.  Rate limiting
+    # and server errors get retried rather than failing the whole org.
+    retry = Retry(
+        total=5, backoff_factor=1.0,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+        allowed_methods=frozenset(['GET'])
+    )
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(
+        pool_connections=1, pool_maxsize=maxsize, max_retries=retry
+    ))
+    session.headers.update({
+        'Accept' : 'application/vnd.github+json',
+        'X-Github-Api-Version' : '2022-11-28',
+    })
+    return session
+
 def github_uat() -> str:
     """Interactively get and return a new GitHub user authentication token.
     
@@ -123,34 +273,37 @@ def github_uat() -> str:
     
     """
 
-    session = requests.Session()
-    params = {'client_id': APP_CLIENT_ID}
-    r = session.post('https://github.com/login/device/code', params=params)
+    with requests.Session() as session:
+        params = {'client_id': APP_CLIENT_ID}
+        r = session.post('https://github.com/login/device/code', params=params)
 
-    qr = {
-        k : v[0] if len(v) == 1 else v
-            for (k, v) in parse_qs(r.text).items()
-    }
-    print("Follow link to", qr['verification_uri'], "to continue.")
-    print("Provide user code:", qr['user_code'])
-
-    # Keep polling to see whether the authorization is complete.
-    interval = int(qr['interval'])
-    params['device_code'] = qr['device_code']
-    params['grant_type'] = 'urn:ietf:params:oauth:grant-type:device_code'
-    while True:
-        time.sleep(interval)
-    
-        r = session.post('https://github.com/login/oauth/access_token', params=params)
-        if r.status_code != 200:
-            raise ValueError(f"Bad HTTP response: {r.status_code}")
-
-        d = parse_qs(r.text)
-        if 'error' in d:
-            error = d['error'][0]
-            if error == 'slow_down':
-                interval = int(d['interval'])
-            elif error != 'authorization_pending':
-                raise ValueError('Github reports error ' + error)
-        else:
-            return d['access_token'][0]
\ No newline at end of file
+        qr = {
+            k : v[0] if len(v) == 1 else v
+                for (k, v) in parse_qs(r.text).items()
+        }
+        print("Follow link to", qr['verification_uri'], "to continue.")
+        print("Provide user code:", qr['user_code'])
+
+        # Keep polling to see whether the authorization is complete.  The
+        # session holds the connection open between polls, and a little
+        # jitter keeps several copies of us from polling in lockstep.
+        interval = int(qr['interval'])
+        params['device_code'] = qr['device_code']
+        params['grant_type'] = 'urn:ietf:params:oauth:grant-type:device_code'
+        while True:
+            time.sleep(interval + random.uniform(0, 1))
+        
+            r = session.post('https://github.com/login/oauth/access_token', params=params)
+            if r.status_code != 200:
+                raise ValueError(f"Bad HTTP response: {r.status_code}")
+
+            d = parse_qs(r.text)
+            if 'error' in d:
+                error = d['error'][0]
+                if error == 'slow_down':
+                    # Github says to add 5 seconds, and usually tells us the new interval
+                    interval = int(d['interval'][0]) if 'interval' in d else interval + 5
+                elif error != 'authorization_pending':
+                    raise ValueError('Github reports error ' + error)
+            else:
+                return d['access_token'][0]
@@ -4,8 +4,8 @@ import argparse
 from pathlib import Path
 
 from . import git, version
-from .github import Github, github_uat
-from .taskqueue import taskqueue
+from .github import Github, MAX_PAGE_REQUESTS, github_session, github_uat
+from .taskqueue import ThreadedTaskQueue
 
 import logging
 log = logging.getLogger(__name__)
@@ -24,7 +24,6 @@ def main(argv = None):
     
     # Configure logging
     rootlogger = logging.getLogger('')
-    rootlogger.setLevel(logging.DEBUG)
     if argns.verbose:
         filelog = logging.FileHandler('linkrottie.log')
         filelog.setFormatter(
@@ -42,6 +41,10 @@ def main(argv = None):
     )
     consolelog.setLevel(logging.INFO if argns.verbose else logging.WARNING)
     rootlogger.addHandler(consolelog)
+
+    # Let the root logger pass what the most verbose handler wants and no
+    # more, so that log.isEnabledFor() can skip work nobody would see.
+    rootlogger.setLevel(min(h.level for h in rootlogger.handlers))
     
     # Read the options file
     if argns.config:
@@ -65,7 +68,10 @@ def main(argv = None):
         print("unable to find configuration file linkrottie.toml", file=sys.stderr)
         return 2
     
-    tq = taskqueue()
+    # Every mirror is a git subprocess waiting on the network, so the number
+    # of worker threads is the number of git processes running at once.
+    parallel = config_data['local'].get('parallel', 8)
+    tq = ThreadedTaskQueue(parallel)
     local = git.local(config_data['local'])
     
     if argns.authorize_github:
@@ -78,16 +84,18 @@ def main(argv = None):
     try:
         github_gather = config_data['gather']['github']
         log.debug('Configuring gather.github')
+        # Every queue worker could be paging through an org at once.
+        session = github_session(parallel * MAX_PAGE_REQUESTS)
         for org, config in github_gather.items():
-            gh = Github(org, config, new_uat=new_uat)
-            tq.append(gh.mirror_org_repos)
+            gh = Github(org, config, new_uat=new_uat, session=session)
+            tq.append(gh.mirror_org_repos, tq)
     except KeyError:
         pass
         
     # Handle explicit remotes
     remotes = config_data['gather'].get('remotes', [])
     for url in remotes:
-        tq.append(local.mirror_repo, url)
+        tq.append(local.mirror_repo, url, tq)
     
     # Run the taskqueue
     tq.runall()
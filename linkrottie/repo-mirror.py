@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 import re
 import subprocess
 from pathlib import Path
 import os
+import functools
 
-from collections import namedtuple
+from dataclasses import dataclass
 
 def get_api_key() -> str:
     with open('API_KEY', 'r') as f:
@@ -16,6 +22,35 @@ def get_api_key() -> str:
     
 API_KEY = get_api_key()
 
+_SESSION = None
+
+def github_session() -> requests.Session:
+    """Get the Session shared by all Github API calls.
+    
+    It keeps connections open across pages, and retries rate limiting and
+    server errors on its own.
+    """
+    
+    global _SESSION
+    if _SESSION is None:
+        retry = Retry(
+            total=5, backoff_factor=1.0,
+            status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=True,
+            allowed_methods=frozenset(['GET'])
+        )
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retry)
+        
+        _SESSION = requests.Session()
+        _SESSION.mount('https://', adapter)
+        _SESSION.mount('http://', adapter)
+        _SESSION.headers.update({
+            'Accept' : 'application/vnd.github+json',
+            'Authorization' : f'Bearer {API_KEY}', 
+            'X-Github-Api-Version' : '2022-11-28',
+        })
+    return _SESSION
+
 def github_org_repos(organization = 'highland-technology-inc'):
     """Get all repositories available to this organization.
     
@@ -24,29 +59,22 @@ def github_org_repos(organization = 'highland-technology-inc'):
     
     """
     
-    sesh = requests.Session()
-    sesh.headers.update({
-        'Accept' : 'application/vnd.github+json',
-        'Authorization' : f'Bearer {API_KEY}', 
-        'X-Github-Api-Version' : '2022-11-28',
-    })
-    
+    sesh = github_session()
     url = f'https://api.github.com/orgs/{organization}/repos'
-    while True:
-        response = sesh.get(url)
+    while url:
+        response = sesh.get(url, timeout=(5, 30))
         response.raise_for_status()
-        yield from response.json()
-        
-        try:
-            link = response.headers['link']
-            mo = re.search(r'<([^>]+)>; rel="next"')
-            if not mo:
-                raise ValueError('invalid link header: ' + link)
-            url = mo.groups(1)
-        except KeyError:
-            break
-    
-def _is_git_dir(start_path:Path) -> bool:
+        yield from json_loads(response.content)
+        url = response.links.get('next', {}).get('url')
+    
+@functools.lru_cache(maxsize=4096)
+def _isdir(path:str) -> bool:
+    """os.path.isdir, cached for paths the walk would otherwise check over
+    and over.  Cleared by local_repos()."""
+    return os.path.isdir(path)
+
+@functools.lru_cache(maxsize=4096)
+def _is_git_dir(start_path:str) -> bool:
     """Determine if p is a git directory.
     
     This is taken from the comments on is_git_directory() in the git source, 
@@ -57,20 +85,34 @@ def _is_git_dir(start_path:Path) -> bool:
     want to be found.
     """
 
-    head = start_path / 'HEAD'
+    with os.scandir(start_path) as it:
+        return _has_git_entries(it)
+
+def _has_git_entries(entries) -> bool:
+    """Determine if a directory's entries are those of a git directory.
+
+    See _is_git_dir.  Working from os.scandir entries, whose types come
+    along with the directory listing, saves a stat on HEAD, objects and refs.
+    """
+
+    head = objects = refs = False
+    for entry in entries:
+        name = entry.name
+        if name == 'HEAD':
+            head = entry.is_symlink() or entry.is_file()
+        elif name == 'objects':
+            objects = entry.is_dir()
+        elif name == 'refs':
+            refs = entry.is_dir()
+
     try:
-        objects = os.environ['GIT_OBJECT_DIRECTORY']
+        objects = _isdir(os.environ['GIT_OBJECT_DIRECTORY'])
     except KeyError:
-        objects = start_path / 'objects'
-    refs = start_path / 'refs'
-    
-    return (
-        (head.is_file() or head.is_symlink()) and
-        objects.is_dir() and
-        refs.is_dir()
-    )
+        pass
+
+    return head and objects and refs
     
-def _walk_until_git(start_path:Path, follow_symlinks=False):
+def _walk_until_git(start_path, follow_symlinks=False):
     """Walk all directories under start_path, yielding git repos.
     
     This is similar to Path.walk, but won't keep recursively looking once
@@ -78,37 +120,57 @@ def _walk_until_git(start_path:Path, follow_symlinks=False):
     what you're pointed at is largely git repos, which in our case it's likely
     to be.
     
+    Each directory is listed once with os.scandir, and everything we need
+    to know about its entries comes from that listing.
+    
     Yields:
         Paths to git repositories.
     """
     
-    # First, check to see if this is a git directory.
-    # If it is, we're done.
-    #
-    if _is_git_dir(start_path):
-        # Should only be a git directory if it's a bare repo; if this is
-        # a .git subdirectory it's an error (because we started in what is
-        # already a subdirectory of the repo.
+    # Directories still to look at.  Working from a stack rather than
+    # recursing saves a generator frame per directory level.
+    stack = [start_path]
+    while stack:
+        path = stack.pop()
+        with os.scandir(path) as it:
+            entries = list(it)
+
+        # First, check to see if this is a git directory.
+        # If it is, we're done with it.
         #
-        if start_path.name == '.git':
-            raise ValueError('start_path is .git subdirectory')
-            
-        yield start_path
-        return
-    
-    # See if there is a .git subdirectory that makes this a working copy.
-    git_subdir = start_path / '.git'
-    if git_subdir.is_dir() and _is_git_dir(git_subdir):
-        yield start_path
-        return
+        if _has_git_entries(entries):
+            # Should only be a git directory if it's a bare repo; if this is
+            # a .git subdirectory it's an error (because we started in what is
+            # already a subdirectory of the repo.
+            #
+            if os.path.basename(path) == '.git':
+                raise ValueError('start_path is .git subdirectory')
+                
+            yield Path(path)
+            continue
         
-    # Nope, recursion is called for.  Go down through any subdirectories.
-    for p in start_path.iterdir():
-        if (p.is_symlink() and follow_symlinks):
-            p = p.resolve(strict=True)
+        # See if there is a .git subdirectory that makes this a working copy,
+        # gathering up the other subdirectories in the same pass.  Once .git
+        # turns up, the rest of them don't matter.
+        working_copy = False
+        subdirs = []
+        for entry in entries:
+            if entry.name == '.git' and entry.is_dir() and _is_git_dir(entry.path):
+                working_copy = True
+                break
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                subdirs.append(entry)
+
+        if working_copy:
+            yield Path(path)
+            continue
             
-        if p.is_dir():
-            yield from _walk_until_git(p, follow_symlinks)
+        # Nope, go down through any subdirectories.
+        for entry in subdirs:
+            subdir = entry.path
+            if follow_symlinks and entry.is_symlink():
+                subdir = os.path.realpath(subdir, strict=True)
+            stack.append(subdir)
     
 def local_repos(start_path, follow_symlinks=False):
     """Get all local repositories under a path.
@@ -117,8 +179,12 @@ def local_repos(start_path, follow_symlinks=False):
         Paths to git respositories.
     """
     
+    # Don't carry cached directory probes over from an earlier walk.
+    _isdir.cache_clear()
+    _is_git_dir.cache_clear()
+
     top = Path(start_path)
-    yield from _walk_until_git(top)
+    yield from _walk_until_git(top, follow_symlinks)
     
 def get_submodules_file(repo_path) -> str:
     """Gets the Git .gitmodules file from the head of repo.
@@ -135,55 +201,69 @@ def get_submodules_file(repo_path) -> str:
     """
     
     
-    result = subprocess.run(
+    # Read raw bytes and decode once, rather than through a text-mode
+    # wrapper on each pipe.
+    proc = subprocess.Popen(
         ['git', 'show', '@:.gitmodules'],
-        capture_output=True,
-        cwd=repo_path,
-        encoding='utf-8'
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=repo_path
     )
-    if result.returncode:
-        if "'.gitmodules' does not exist" in result.stderr:
+    out, err = proc.communicate()
+    if proc.returncode:
+        if b"'.gitmodules' does not exist" in err:
             return None
-        if 'not a git repository' in result.stderr:
+        if b'not a git repository' in err:
             raise FileNotFoundError(f'Not a git repository: {repo_path}')
-        result.check_returncode()
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, out, err)
 
-    return result.stdout
+    return out.decode('utf-8', errors='replace')
 
 
-RemoteRepo = namedtuple('RemoteRepo', 'scheme user host port path'.split())
+# URL specified locations
+_URL_SCHEME_RE = re.compile(r'''
+    (\w+)://                # scheme,   exclude ://
+    (?:([^/?#@:]+)@)?       # user,     exclude @
+    ([^/?#@:]*)             # host
+    (?::(\d+))?             # port,     exclude :
+    (/.*)                   # path
+''', re.X)
+
+# SCP specified locations
+_URL_SCP_RE = re.compile(r'''
+    (?:([^/?#@:]+)@)?       # user,     exclude @
+    ([^/?#@:]*)             # host
+    :
+    (.*)                    # path
+''', re.X)
+
+@dataclass(slots=True, frozen=True)
+class RemoteRepo:
+    """Represents the parts of a remote repository."""
+    scheme: str = ''
+    user: str = ''
+    host: str = ''
+    port: str = ''
+    path: str = ''
 
 def parse_url(url: str):
     """Parse a URL that points to a remote git repository into
     constituent parts."""
     
     # Look for URL specified locations
-    mo = re.match(r'''
-        (\w+)://                # scheme,   exclude ://
-        (?:([^/?#@:]+)@)?       # user,     exclude @
-        ([^/?#@:]*)             # host
-        (?::(\d+))?             # port,     exclude :
-        (/.*)                   # path
-    ''', url, re.X)
-    
+    mo = _URL_SCHEME_RE.match(url)
     if mo:
         # Extract and clean the parts of the URL
-        return RemoteRepo(*mo.groups())
+        return RemoteRepo(*(g or '' for g in mo.groups()))
     
     # Look for SCP specified locations
-    mo = re.match(r'''
-        (?:([^/?#@:]+)@)?       # user,     exclude @
-        ([^/?#@:]*)             # host
-        :
-        (.*)                    # path
-    ''', url, re.X)
+    mo = _URL_SCP_RE.match(url)
     if mo:
-        scheme = port = None
         user, host, path = mo.groups()
-        return RemoteRepo(scheme, user, host, port, path)
+        return RemoteRepo(user=user or '', host=host, path=path)
         
     # Look for local file specified locations
-    return RemoteRepo('', '', '', '', url)
+    return RemoteRepo(path=url)
 
 if __name__ == '__main__':
     #print(get_repos())
@@ -15,22 +15,30 @@ task to mirror that submodules.  And so on and so on until all the tasks
 are complete, and then the program is done.
 """
 
-import queue
 import threading
 import logging
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 log = logging.getLogger(__name__)
 
+class _TaskNumber(int):
+    """Default description for a task, only formatted if it gets logged."""
+
+    def __str__(self):
+        return f'task_{int(self)}'
+
 class SingleTaskQueue:
     """Single-threaded, simple implementation of a TaskQueue.
     
-    Ideally this would be smartened up through the use of concurrent.futures
-    and a ThreadPoolExecutor, but that's a job for later; this is easy for now.
+    Handy for debugging; ThreadedTaskQueue is the one that actually gets
+    things done in parallel.
     """
     
     def __init__(self):
-        self._queue = []
-        self._next_task = 1
+        self._queue = deque()
+        self._task_numbers = itertools.count(1)
     
     def append(self, task, *args, desc=None, **kwargs):
         """Append a task to the queue.
@@ -42,9 +50,9 @@ class SingleTaskQueue:
         """
         
         if desc is None:
-            desc = f'task_{self._next_task}'
-        log.debug("Queuing {%s}", desc)
-        self._next_task += 1
+            desc = _TaskNumber(next(self._task_numbers))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Queuing {%s}", desc)
         self._queue.append((task, desc, args, kwargs))
 
     def runall(self):
@@ -53,17 +61,16 @@ class SingleTaskQueue:
         This includes new events added to the queue by events in the queue.
         """
         while self._queue:
-            (task, desc, args, kwargs) = self._queue.pop(0)
-            log.debug("Executing {%s,%s,%s}", desc, args, kwargs)
+            (task, desc, args, kwargs) = self._queue.popleft()
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Executing {%s,%s,%s}", desc, args, kwargs)
             task(*args, **kwargs)
-            log.debug("Completed {%s}", desc)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Completed {%s}", desc)
             
     def __len__(self):
         return len(self._queue)
 
-class _TerminateThread(Exception):
-    pass
-
 class ThreadedTaskQueue:
     """Multi-threaded implementation of a TaskQueue.
 
@@ -74,75 +81,86 @@ class ThreadedTaskQueue:
     
     def __init__(self, max_tasks:int = 4):
         self._lock = threading.Lock()
-        self._queue = queue.Queue()
-        self._next_task = 1
-        self._threads = [
-            threading.Thread(target=self._runthread, daemon=False)
-                for _ in range(max_tasks)
-        ]
+        self._idle = threading.Condition(self._lock)
+        self._executor = ThreadPoolExecutor(max_workers=max_tasks)
+        self._pending = set()
+        self._waiting = []
+        self._running = False
+        self._task_numbers = itertools.count(1)
     
     def append(self, task, *args, desc=None, **kwargs):
         """Append a task to the queue.
-        
+
+        Tasks appended before runall() wait for it to start.  After that,
+        the task is handed to the thread pool right away.
+
         Args:
             desc: Logging description for this task.
             
             Other arguments are passed to the task when called.
         """
         
+        # next() on a count is atomic in CPython, no need to lock for it.
         if desc is None:
-            desc = f'task_{self._next_task}'
-        log.debug("Queuing {%s}", desc)
-
+            desc = _TaskNumber(next(self._task_numbers))
         with self._lock:
-            self._next_task += 1
-        self._queue.put((task, desc, args, kwargs))
+            if not self._running:
+                self._waiting.append((task, desc, args, kwargs))
+                future = None
+            else:
+                future = self._submit(task, desc, args, kwargs)
 
-    def _killthread(self):
-        raise _TerminateThread()
+        # Outside the lock; a task that's already done calls back right away.
+        if future is not None:
+            future.add_done_callback(self._taskdone)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Queuing {%s}", desc)
 
-    def _runthread(self):
-        """Executes queue events while possible."""
+    def _submit(self, task, desc, args, kwargs):
+        """Hand a task to the thread pool.  Call with the lock held."""
 
-        while True:
-            try:
-                (task, desc, args, kwargs) = self._queue.get()
-                log.debug("Executing {%s,%s,%s}", desc, args, kwargs)
-                task(*args, **kwargs)
-            except _TerminateThread:
-                break
-            except Exception:
-                log.exception('unhandled exception')
-            finally:
-                self._queue.task_done()
-                log.debug("Completed {%s}, %d items in queue", desc, len(self))
-        
-        log.debug('Terminating thread')
+        future = self._executor.submit(self._runtask, task, desc, args, kwargs)
+        self._pending.add(future)
+        return future
+
+    def _runtask(self, task, desc, args, kwargs):
+        """Executes one queue event in a worker thread."""
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Executing {%s,%s,%s}", desc, args, kwargs)
+        try:
+            task(*args, **kwargs)
+        except Exception:
+            log.exception('unhandled exception')
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Completed {%s}, %d items in queue", desc, len(self) - 1)
+
+    def _taskdone(self, future):
+        """Forget a finished task, and wake runall() if it was the last."""
+
+        with self._lock:
+            self._pending.discard(future)
+            if not self._pending:
+                self._idle.notify_all()
     
     def runall(self):
         """Executes all events in the queue.  Run from main thread.
         
         This includes new events added to the queue by events in the queue.
+        A task queues its children before it completes, so the queue can't
+        run dry while there's still work coming.
         """
         
-        # Run all the threads, and the entire queue through to completion
-        for t in self._threads:
-            t.start()
-        self._queue.join()
-
-        # Send all the threads a termination notice
-        for n, t in enumerate(self._threads):
-            self.append(self._killthread, desc=f'Terminate {n}')
-        
-        # And wait for them to complete
-        for t in self._threads:
-            t.join()
+        with self._lock:
+            self._running = True
+            futures = [self._submit(*t) for t in self._waiting]
+            self._waiting.clear()
+        for future in futures:
+            future.add_done_callback(self._taskdone)
+
+        with self._lock:
+            self._idle.wait_for(lambda: not self._pending)
+        self._executor.shutdown()
             
     def __len__(self):
-        return self._queue.qsize()
-
-_tq = ThreadedTaskQueue()
-
-def taskqueue():
-    """Return the global TaskQueue."""
-    return _tq
+        return len(self._pending) + len(self._waiting)
@@ -0,0 +1,88 @@
+import subprocess
+import pytest
+
+from linkrottie.git import RemoteRepo, RemoteRepoUrl, RemoteRepoScp, RemoteRepoFile
+from linkrottie.git import get_submodule_urls
+
+urls = [
+	'https://github.com/highland-technology-inc/linkrottie.git',
+	'ssh://git@github.com:22/highland-technology-inc/linkrottie.git',
+	'git@github.com:highland-technology-inc/linkrottie.git',
+	'/srv/git/linkrottie.git',
+]
+
+def test_parse_url():
+	repo = RemoteRepo.parse_url(urls[1])
+	assert isinstance(repo, RemoteRepoUrl)
+	assert (repo.scheme, repo.user, repo.host, repo.port, repo.path) == (
+		'ssh', 'git@', 'github.com', ':22', '/highland-technology-inc/linkrottie.git'
+	)
+	
+	repo = RemoteRepo.parse_url(urls[2])
+	assert isinstance(repo, RemoteRepoScp)
+	assert (repo.user, repo.host, repo.path) == (
+		'git@', 'github.com', 'highland-technology-inc/linkrottie.git'
+	)
+	
+	repo = RemoteRepo.parse_url(urls[3])
+	assert isinstance(repo, RemoteRepoFile)
+	assert repo.path == urls[3]
+
+def test_deparse():
+	for url in urls:
+		assert RemoteRepo.parse_url(url).deparse() == url, url
+
+def test_join_url():
+	repo = RemoteRepo.parse_url('git@github.com:highland-technology-inc/linkrottie.git')
+	assert repo.join_url('../other.git').deparse() == 'git@github.com:highland-technology-inc/other.git'
+	
+	repo = RemoteRepo.parse_url('https://github.com/highland-technology-inc/linkrottie.git')
+	assert repo.join_url('../other.git').deparse() == 'https://github.com/highland-technology-inc/other.git'
+	assert repo.join_url('/org/other.git').deparse() == 'https://github.com/org/other.git'
+
+def git(path, *args):
+	subprocess.run(
+		['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args],
+		cwd=path, check=True, capture_output=True
+	)
+
+def make_repo(path, gitmodules=None):
+	"""Make a repo at path with one commit, with a .gitmodules file if given."""
+	path.mkdir()
+	git(path, 'init', '-q')
+	if gitmodules is not None:
+		(path / '.gitmodules').write_text(gitmodules)
+		git(path, 'add', '.gitmodules')
+	git(path, 'commit', '-q', '--allow-empty', '-m', 'initial')
+	return path
+
+def test_get_submodule_urls(tmp_path):
+	repo = make_repo(tmp_path / 'repo',
+		'[submodule "name with space"]\n'
+		'\tpath = lib/a\n'
+		'\turl = git@github.com:org/a.git\n'
+		'[submodule "b"]\n'
+		'\tpath = lib/b\n'
+		'\turl = ../x.git\n'
+	)
+	assert get_submodule_urls(repo) == ['git@github.com:org/a.git', '../x.git']
+
+def test_get_submodule_urls_no_gitmodules(tmp_path):
+	repo = make_repo(tmp_path / 'repo')
+	assert get_submodule_urls(repo) == []
+
+def test_get_submodule_urls_no_commits(tmp_path):
+	repo = tmp_path / 'repo'
+	repo.mkdir()
+	git(repo, 'init', '-q')
+	assert get_submodule_urls(repo) == []
+
+def test_get_submodule_urls_no_url_keys(tmp_path):
+	repo = make_repo(tmp_path / 'repo', '[submodule "a"]\n\tpath = lib/a\n')
+	assert get_submodule_urls(repo) == []
+
+def test_get_submodule_urls_not_a_repo(tmp_path, monkeypatch):
+	# Don't let git find some repo the temporary directory happens to be in.
+	monkeypatch.setenv('GIT_CEILING_DIRECTORIES', str(tmp_path.parent))
+	with pytest.raises(FileNotFoundError):
+		get_submodule_urls(tmp_path)
@@ -1,15 +1,12 @@
-from linkrottie.taskqueue import taskqueue
+from linkrottie.taskqueue import SingleTaskQueue, ThreadedTaskQueue
 from collections import Counter
 from threading import Lock
+import time
 
-ctr = Counter()
-lock = Lock()
-
-def task(n:int):
-	tq = taskqueue()
+def task(tq, ctr:Counter, lock:Lock, n:int):
 	if n < 10:
-		tq.append(task, n+1, desc=f"Task {n}+1")
-		tq.append(task, n*2, desc=f"Task {n}*2")
+		tq.append(task, tq, ctr, lock, n+1, desc=f"Task {n}+1")
+		tq.append(task, tq, ctr, lock, n*2, desc=f"Task {n}*2")
 	
 	with lock:
 		ctr[n] += 1
@@ -20,14 +17,15 @@ def simulate_task(c:Counter, n:int):
 		simulate_task(c, n+1)
 		simulate_task(c, n*2)
 
-def test_taskqueue():
+def run_taskqueue(tq):
 	test_counter = Counter()
 	simulate_task(test_counter, 2)
 	simulate_task(test_counter, 3)
 	
-	tq = taskqueue()
-	tq.append(task, 2, desc="Initial task 2")
-	tq.append(task, 3, desc="Initial task 3")
+	ctr = Counter()
+	lock = Lock()
+	tq.append(task, tq, ctr, lock, 2, desc="Initial task 2")
+	tq.append(task, tq, ctr, lock, 3, desc="Initial task 3")
 	tq.runall()
 	
 	assert test_counter.keys() == ctr.keys(), "Keys don't match"
@@ -36,3 +34,21 @@ def test_taskqueue():
 		print(f'[{k}] =  {v}')
 		assert v == ctr[k], f"Key {k} expected {v}, got {ctr[k]}"
 
+def test_taskqueue():
+	run_taskqueue(ThreadedTaskQueue())
+
+def test_singletaskqueue():
+	run_taskqueue(SingleTaskQueue())
+
+def test_nothing_runs_before_runall():
+	ran = []
+	tq = ThreadedTaskQueue()
+	tq.append(ran.append, 1)
+	tq.append(ran.append, 2)
+	time.sleep(0.1)
+	assert ran == [], "Task ran before runall()"
+	assert len(tq) == 2
+	
+	tq.runall()
+	assert sorted(ran) == [1, 2]
+	assert len(tq) == 0